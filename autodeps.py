@@ -6,24 +6,40 @@ changes.
 """
 
 import argparse
-import datetime
+import copy
 import errno
 import fcntl
 import getpass
+import glob
 import hashlib
 import json
 import os
 import platform
 import random
 import re
+import select
+import shlex
 import shutil
 import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 import time
+import urllib2
+import zlib
 
 CONFIG_PATHS = ['autodeps.json']
+# One requirement per line, minus surrounding whitespace and # comments
+REQUIREMENT_LINE_RE = re.compile(r'^[ \t]*([^#\n]*?)[ \t\r]*(?:#.*)?$', re.M)
+# Trailing backslash joins the next line, except on comment lines (as in pip)
+LINE_CONTINUATION_RE = re.compile(r'^([^#\n]*)\\\r?\n', re.M)
+# Short package names for log files, e.g. git+https://host/foo-bar
+PACKAGE_URL_NAME_RE = re.compile(r'.*/([a-zA-Z-]+)')
+PACKAGE_TAIL_NAME_RE = re.compile(r' ([a-zA-Z]+)$')
+# Requirement lines for pip itself, e.g. pip>=19.2 but not pip-tools
+PIP_REQUIREMENT_RE = re.compile(r'[ \t]*pip(?![\w.-])', re.I)
 
 
 class Autodeps(object):
@@ -33,6 +49,7 @@ class Autodeps(object):
     self.step_prefix = ''  # progress printout only
     self.current_step = 0  # progress printout only
     self.total_steps = 1  # progress printout only
+    self.parallel_steps = False  # progress printout only
     self.autodeps_dir = os.path.abspath(os.path.dirname(__file__))
     kwargs['autodeps_dir'] = self.autodeps_dir
     kwargs['user'] = getpass.getuser()
@@ -41,35 +58,20 @@ class Autodeps(object):
                               for path in self.config['requirements']]
     self.requirements = []
     for path in requirements_filenames:
-      self.requirements += [re.sub(r'[#].*', '', line).strip()
-                            for line in open(path)]
-    self.requirements = filter(len, self.requirements)
-    self.deps_hash = hashlib.sha224(platform.python_version() +
-                                    repr(self.requirements)).hexdigest()[:40]
+      with open(path) as fd:
+        data = LINE_CONTINUATION_RE.sub(r'\1', fd.read())
+      self.requirements.extend(
+          line for line in REQUIREMENT_LINE_RE.findall(data) if line)
+    deps_hash = hashlib.sha224()
+    # Sorted so that reordering requirements does not invalidate archives
+    deps_hash.update(to_bytes('\n'.join(sorted(self.requirements)) + '\n' +
+                              platform.python_version()))
+    self.deps_hash = deps_hash.hexdigest()[:40]
     kwargs['deps_hash'] = self.deps_hash
 
     # Perform a search for a suitable self.virtualenv_dir
-    self.virtualenv_dir = None
-    paths = [path.format(**kwargs) for path in self.config['venv-dir-search']]
-    for path in paths:
-      if os.path.exists(path) or os.path.exists(path + '.lock'):
-        # Use existing version
-        self.virtualenv_dir = path
-        break
-    if self.virtualenv_dir is None:
-      for path in paths:
-        if freespace_gb(path) > self.config.get(
-                'venv-dir-required-gigabytes', 1.0):
-          try:
-            os.makedirs(path)
-            self.virtualenv_dir = path
-            break
-          except OSError:
-            if os.path.exists(path) or os.path.exists(path + '.lock'):
-              # Caught race condition where someone else created it first
-              self.virtualenv_dir = path
-              break
-              # Not enough permissions, try next one
+    self.virtualenv_dir = self.pick_venv_dir(
+        [path.format(**kwargs) for path in self.config['venv-dir-search']])
     assert self.virtualenv_dir is not None
     kwargs['venv_dir'] = self.virtualenv_dir
 
@@ -87,6 +89,40 @@ class Autodeps(object):
     self.submodule_update_path = self.expand_path(
         self.config.get('submodule-update'), kwargs)
     self.pip_extra = self.config.get('pip-args', '').format(**kwargs)
+    self.pip_extra_args = shlex.split(self.pip_extra)
+    self.pip_cache_dir = self.config.get('pip-cache-dir', '').format(**kwargs)
+    if not self.pip_cache_dir:
+      # Only if it exists: creating archive_dir opts in to make_archive()
+      if self.archive_dir and os.path.isdir(self.archive_dir):
+        self.pip_cache_dir = os.path.join(self.archive_dir, 'pip')
+      else:
+        self.pip_cache_dir = os.path.expanduser('~/.cache/autodeps/pip')
+    self.pip_per_package = self.config.get('pip-per-package-logs', False)
+    self.pip_jobs = self.config.get('pip-jobs', 4)
+    self.venv_symlinks = self.config.get('venv-symlinks', False)
+    self.use_uv = self.config.get('use-uv', True)
+    self.uv_args = shlex.split(self.config.get('uv-args', '').format(**kwargs))
+
+  def pick_venv_dir(self, paths):
+    """
+    Return the first of paths already in use, otherwise the first one with
+    enough free space that we are able to create
+    """
+    for path in paths:
+      if os.path.exists(path) or os.path.exists(path + '.lock'):
+        # Use existing version
+        return path
+    required_gb = self.config.get('venv-dir-required-gigabytes', 1.0)
+    freespace_cache = dict()  # candidates often share a filesystem
+    for path in paths:
+      if freespace_gb(path, freespace_cache) > required_gb:
+        try:
+          makedirs(path)  # fine if someone else created it first
+        except OSError:
+          continue  # Not enough permissions, try next one
+        if os.access(path, os.W_OK):
+          return path
+    return None
 
   def load_config(self, config_file, kwargs):
     """
@@ -95,11 +131,11 @@ class Autodeps(object):
     config = dict()
     for path in CONFIG_PATHS:
       try:
-        config.update(json.load(open(self.expand_path(path, kwargs))))
+        config.update(load_json(self.expand_path(path, kwargs)))
       except IOError:
         pass  # No configuration
     if config_file:
-      config.update(json.load(open(self.expand_path(config_file, kwargs))))
+      config.update(load_json(self.expand_path(config_file, kwargs)))
     return config
 
   @staticmethod
@@ -138,13 +174,16 @@ class Autodeps(object):
     """Create or fix .venv_latest symlink"""
     link_filename = self.venv_latest_filename
     try:
-      if not os.path.exists(link_filename) or not os.path.samefile(
-              link_filename, self.virtualenv_dir):
-        try:
-          os.unlink(link_filename)
-        except OSError:
-          pass  # file does not exist
-        os.symlink(self.virtualenv_dir, link_filename)
+      if os.readlink(link_filename) == self.virtualenv_dir:
+        return  # already correct, the common case
+    except OSError:
+      pass  # does not exist or not a symlink
+    try:
+      try:
+        os.unlink(link_filename)
+      except OSError:
+        pass  # file does not exist
+      os.symlink(self.virtualenv_dir, link_filename)
     except OSError:
       pass  # a race with another autodeps.py process -- ignore it
 
@@ -152,32 +191,57 @@ class Autodeps(object):
     """
     Create and populate venv_dir if it does not exist
     """
-    self.venv_lastest_symlink()
-    if os.path.exists(os.path.join(self.virtualenv_dir, '.completed')):
+    if self.venv_is_ready():
+      self.venv_lastest_symlink()
       return
     old_dir = os.getcwd()
     os.chdir(self.autodeps_dir)
     self.lock_venv_dir()
-    if not os.path.exists(os.path.join(self.virtualenv_dir, '.completed')):
+    if not self.venv_is_ready():
       if not self.search_for_precompiled_archive():
         self.info('deps changed, rebuilding virtualenv (this may take a while)')
         self.update_unsafe()
-      with open(os.path.join(self.virtualenv_dir, '.completed'), 'w') as fd:
-        fd.write(repr(datetime.datetime.now()))
     self.unlock_venv_dir()
-    try:
-      os.unlink(self.lockfilename)
-    except OSError:
-      pass
+    self.venv_lastest_symlink()
     os.chdir(old_dir)
 
+  def venv_is_ready(self):
+    """
+    True if venv_dir holds a finished build for self.deps_hash.  Builds are
+    renamed into place only once complete, so .deps_hash never shows up early.
+    """
+    try:
+      with open(os.path.join(self.virtualenv_dir, '.deps_hash')) as fd:
+        return fd.read() == self.deps_hash
+    except IOError:
+      return False
+
+  def replace_venv_dir(self, build_dir):
+    """
+    Move a fully built build_dir over venv_dir.  The old venv_dir is renamed
+    out of the way and deleted in the background, since removing thousands
+    of small files can take seconds.
+    """
+    parent_dir, venv_name = os.path.split(self.virtualenv_dir)
+    trash_dir = tempfile.mkdtemp(prefix=venv_name + '.old', dir=parent_dir)
+    try:
+      os.rename(self.virtualenv_dir, os.path.join(trash_dir, venv_name))
+    except OSError as error:
+      if error.errno != errno.ENOENT:
+        raise
+    os.rename(build_dir, self.virtualenv_dir)
+    # Also clean up after runs that were killed before their delete finished
+    trash_dirs = glob.glob(os.path.join(parent_dir, venv_name + '.old*'))
+    # Not a daemon thread, so the interpreter finishes the delete on exit
+    threading.Thread(target=rmtrees, args=(trash_dirs,)).start()
+
   def update_unsafe(self):
     """
     Create venv environment without checks or concurrency safety.  Requires
     working directory in script directory.
     """
     self.total_steps = (4 + int(bool(self.submodule_update_path)) +
-                        len(self.requirements))
+                        self.pip_install_steps())
 
     # Use a extra .build directory then rename it, so that non-relocatable deps
     # errors manifest all the time
@@ -188,17 +252,13 @@ class Autodeps(object):
     self.submodule_update()
     self.create_virtualenv()
     self.tag_revision()
-    with open(os.path.join(self.virtualenv_dir, 'requirements.txt'), 'w') as fd:
-      fd.write('\n'.join(self.requirements) + '\n')
     self.pip_install_packages()
     self.venv_relocatable()
-    try:
-      shutil.rmtree(old_venv_dir)
-    except OSError as error:
-      if error.errno != errno.ENOENT:
-        raise
-    os.rename(self.virtualenv_dir, old_venv_dir)
+    with open(os.path.join(self.virtualenv_dir, '.deps_hash'), 'w') as fd:
+      fd.write(self.deps_hash)
+    build_dir = self.virtualenv_dir
     self.virtualenv_dir = old_venv_dir
+    self.replace_venv_dir(build_dir)
 
     self.make_archive()
 
@@ -207,37 +267,126 @@ class Autodeps(object):
     Search for precomputed tar.gz we can use, if found extract it and
     return true
     """
+    if self.copy_archive_dir():
+      self.submodule_update()
+      return True
     for search_dir in [self.archive_dir] + list(self.config['venv-dir-search']):
-      tarfile = os.path.join(search_dir,
-                             '{0}.tar.gz'.format(self.deps_hash))
-      if os.path.exists(tarfile):
+      tarfile_path = os.path.join(search_dir,
+                                  '{0}.tar.gz'.format(self.deps_hash))
+      if is_url(tarfile_path):
+        if not tarfile_path.startswith('https://'):
+          self.info('ignoring {0}, archives are only downloaded over https'
+                    .format(tarfile_path))
+          continue
         try:
-          os.makedirs(os.path.dirname(self.virtualenv_dir))
-        except OSError:
-          pass
-        self.total_steps = 2
-        self.call_installer('Extracting {0} to {1}'.format(tarfile,
-                                                           self.virtualenv_dir),
-                            'tar -C "{1}" -xzf "{0}"'.format(
-                                tarfile, os.path.dirname(self.virtualenv_dir)))
-        self.submodule_update()
-        return True
+          fileobj = urllib2.urlopen(tarfile_path, timeout=60)
+        except IOError:
+          continue  # not found or not reachable
+      elif os.path.exists(tarfile_path):
+        fileobj = None
+      else:
+        continue
+      parent_dir, venv_name = os.path.split(self.virtualenv_dir)
+      makedirs(parent_dir)
+      self.total_steps = self.current_step + 2
+      step = self.begin_step('Extracting {0} to {1}'.format(
+          tarfile_path, self.virtualenv_dir))
+      # Extract next to venv_dir then rename, so it appears all at once
+      extract_dir = tempfile.mkdtemp(prefix=venv_name + '.extract',
+                                     dir=parent_dir)
+      try:
+        self._extract_tar_stream(tarfile_path, extract_dir, fileobj)
+        self.replace_venv_dir(os.path.join(extract_dir, venv_name))
+      except (tarfile.TarError, IOError, zlib.error) as error:
+        if fileobj is None:
+          raise
+        # e.g. an html error page or a dropped connection, build it instead
+        self.end_step(step, 'ERROR')
+        self.info('failed to download {0}: {1}'.format(tarfile_path, error))
+        continue
+      finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+      self.end_step(step)
+      self.submodule_update()
+      return True
     return False
 
+  def copy_archive_dir(self):
+    """
+    If make_archive_dir() left an uncompressed venv on our filesystem, copy
+    it with reflinks (only metadata is written on CoW filesystems) and
+    return true
+    """
+    if not self.archive_dir:
+      return False
+    archive_dir = os.path.join(self.archive_dir, self.deps_hash)
+    parent_dir = os.path.dirname(self.virtualenv_dir)
+    if (not os.path.isdir(archive_dir) or
+            not same_filesystem(archive_dir, parent_dir)):
+      return False
+    self.total_steps = self.current_step + 2
+    build_dir = self.virtualenv_dir + '.build'
+    logfilename = self.virtualenv_dir + '.copy.log'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    try:
+      self.call_installer('Copying {0} to {1}'.format(archive_dir,
+                                                      self.virtualenv_dir),
+                          ['cp', '-a', '--reflink=auto', archive_dir,
+                           build_dir],
+                          logfilename)
+    except Exception:
+      shutil.rmtree(build_dir, ignore_errors=True)
+      self.info('falling back to the tar archive')
+      return False
+    os.rename(logfilename, os.path.join(build_dir, 'copy.log'))
+    self.replace_venv_dir(build_dir)
+    return True
+
+  @staticmethod
+  def _extract_tar_stream(tarfile_path, dest, fileobj=None):
+    """
+    Extract a .tar.gz in-process, reading it sequentially in a single pass.
+    fileobj, if given, is the already opened (e.g. HTTP) stream to read.
+    """
+    if fileobj is not None:
+      tf = tarfile.open(fileobj=fileobj, mode='r|gz')
+    else:
+      tf = tarfile.open(tarfile_path, 'r|gz')
+    try:
+      # Archives come from shared directories, so unlike extractall() refuse
+      # anything that would write outside dest (as GNU tar does)
+      directories = []
+      for member in tf:
+        check_tar_member(member, dest)
+        if member.isdir():
+          # Like extractall(), keep directories writable until the end
+          directories.append(member)
+          member = copy.copy(member)
+          member.mode = 0o700
+        tf.extract(member, dest)
+      directories.sort(key=lambda member: member.name, reverse=True)
+      for member in directories:
+        path = os.path.join(dest, member.name)
+        tf.chown(member, path)
+        tf.utime(member, path)
+        tf.chmod(member, path)
+    finally:
+      tf.close()
+      if fileobj is not None:
+        fileobj.close()
+
   def mkdirs(self):
     """
     Create all needed directories for build
     """
-    if not os.path.exists(self.virtualenv_dir):
-      try:
-        os.makedirs(self.virtualenv_dir)
-      except:
-        pass
+    makedirs(self.virtualenv_dir)
 
   def lock_venv_dir(self):
     """
     Multiple processes might want the same environment, use posix file
-    locking to make only one of them builds it
+    locking to make only one of them builds it.  The lockfile is never
+    unlinked: another process could otherwise open and lock a new file under
+    the same name while we still hold the lock on the old one.
     """
     self.lock_file = open(self.lockfilename, 'a')
     fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
@@ -254,34 +403,46 @@ class Autodeps(object):
     if self.submodule_update_path:
       try:
         self.call_installer('Updating submodules',
-                            'cd {} && git submodule update --init'.format(
-                                self.submodule_update_path),
-                            os.path.join(self.virtualenv_dir, 'submodules.log'))
+                            ['git', 'submodule', 'update', '--init'],
+                            os.path.join(self.virtualenv_dir, 'submodules.log'),
+                            cwd=self.submodule_update_path)
       except:
         pass  # error will already be printed to stderr
 
   def create_virtualenv(self):
     self.call_installer('Creating venv {0}'.format(self.virtualenv_dir),
-                        '{} --always-copy "{}"'.format(self.virtualenv_command,
-                                                       self.virtualenv_dir),
+                        shlex.split(self.virtualenv_command) +
+                        ([] if self.venv_symlinks else ['--always-copy']) +
+                        [self.virtualenv_dir],
                         os.path.join(self.virtualenv_dir, 'venv.log'))
 
   def tag_revision(self):
-    self.call_installer('Recording git revision',
-                        'git show HEAD | head -n 3',
-                        os.path.join(self.virtualenv_dir, 'revision'))
+    step = self.begin_step('Recording git revision')
+    with open(os.devnull, 'w') as devnull:
+      try:
+        revision = subprocess.check_output(
+            ['git', 'log', '-1',
+             '--pretty=format:commit %H%nAuthor: %an <%ae>%nDate:   %ad%n'],
+            stderr=devnull)
+      except (OSError, subprocess.CalledProcessError):
+        revision = b''  # not a git checkout
+    with open(os.path.join(self.virtualenv_dir, 'revision'), 'wb') as fd:
+      fd.write(revision)
+    self.end_step(step)
 
   def venv_relocatable(self):
     self.call_installer('Making venv relocatable',
-                        '"{}" --relocatable --system-site-packages "{}"'
-                        .format(self.virtualenv_command,
-                                self.virtualenv_dir),
+                        shlex.split(self.virtualenv_command) +
+                        ['--relocatable', '--system-site-packages',
+                         self.virtualenv_dir],
                         os.path.join(self.virtualenv_dir, 'relocatable.log'))
 
   def make_archive(self):
     """
     Try to tar up venv_dir in a public place so others can use it
     """
+    if self.venv_symlinks:
+      return  # links into the system python, which extraction would refuse
     if not os.access(self.archive_dir, os.W_OK):
       return
     tmpdst = os.path.join(self.archive_dir, '{0}_{1}.tar.gz'.format(
@@ -290,43 +451,188 @@ class Autodeps(object):
                        '{0}.tar.gz'.format(self.deps_hash))
     if os.path.exists(dst):
       return
-    srcdir, srcfile = os.path.split(self.virtualenv_dir)
-    self.call_installer('Making tar archive',
-                        'tar -C "{1}" -czf "{0}" {2}'.format(tmpdst, srcdir,
-                                                             srcfile),
-                        os.path.join(self.virtualenv_dir, 'archive.log'))
+    srcfile = os.path.basename(self.virtualenv_dir)
+    step = self.begin_step('Making tar archive')
+    self._write_tar_stream(self.virtualenv_dir, srcfile, tmpdst)
+    self.end_step(step)
     os.chmod(tmpdst, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
     os.rename(tmpdst, dst)
+    self.make_archive_dir()
+
+  def make_archive_dir(self):
+    """
+    Also keep an uncompressed copy of venv_dir for copy_archive_dir(), but
+    only where the filesystem can reflink it instead of copying the data
+    """
+    dst = os.path.join(self.archive_dir, self.deps_hash)
+    if (os.path.exists(dst) or
+            not same_filesystem(self.archive_dir, self.virtualenv_dir)):
+      return
+    tmpdst = '{0}_{1}'.format(dst, random.randint(0, 2 ** 31))
+    with open(os.devnull, 'w') as devnull:
+      returncode = subprocess.call(['cp', '-a', '--reflink=always',
+                                    self.virtualenv_dir, tmpdst],
+                                   stdout=devnull, stderr=devnull)
+    if returncode != 0:
+      shutil.rmtree(tmpdst, ignore_errors=True)  # reflinks not supported
+      return
+    try:
+      os.rename(tmpdst, dst)
+    except OSError:
+      shutil.rmtree(tmpdst, ignore_errors=True)  # someone else made it first
+
+  @staticmethod
+  def _write_tar_stream(src, arcname, dst):
+    """
+    Write src to dst as a .tar.gz in-process.  Compression favors speed since
+    archives are decompressed far more often than they are built.
+    """
+    pigz = find_executable('pigz')
+    if pigz is None:
+      tf = tarfile.open(dst, 'w:gz', compresslevel=1)
+      try:
+        tf.add(src, arcname=arcname)
+      finally:
+        tf.close()
+      return
+    # pigz compresses on all cores
+    with open(dst, 'wb') as fd:
+      process = subprocess.Popen([pigz, '-1', '-c'], stdin=subprocess.PIPE,
+                                 stdout=fd)
+      try:
+        tf = tarfile.open(fileobj=process.stdin, mode='w|')
+        try:
+          tf.add(src, arcname=arcname)
+        finally:
+          tf.close()
+      finally:
+        process.stdin.close()
+        process.wait()
+    if process.returncode != 0:
+      raise Exception('pigz failed writing {0}'.format(dst))
+
+  def pip_install_steps(self):
+    """
+    Number of progress steps pip_install_packages() will print
+    """
+    if self.pip_per_package:
+      return len(self.requirements)
+    return 1 + len(self.pip_requirements())
+
+  def pip_requirements(self):
+    """
+    Requirement lines for pip itself, these are installed before the rest
+    """
+    return [line for line in self.requirements
+            if PIP_REQUIREMENT_RE.match(line)]
 
   def pip_install_packages(self, globally=False):
     """
     Install all of the required pip packages to the virtual environment
     """
+    requirements_path = os.path.join(self.virtualenv_dir, 'requirements.txt')
+    with open(requirements_path, 'w') as fd:
+      fd.write('\n'.join(self.requirements) + '\n')
+    pip_command = self.pip_command(globally)
+    env = self.pip_env()
+    # Upgrade pip first, so everything else is installed by the new pip
+    # rather than the old one bundled with virtualenv
+    pip_requirements = self.pip_requirements()
     self.step_prefix = 'Installing pip package '
-    for package in self.requirements:
-      match = re.match('.*/([a-zA-Z-]+)', package)
-      if match is None:
-        match = re.search(' ([a-zA-Z]+)$', package)
-      package_short = match.group(1) if match else package
-      logfilename = os.path.join(self.virtualenv_dir, package_short + '.out')
-      logfilename_verbose = os.path.join(self.virtualenv_dir,
-                                         package_short + '.log')
-      if globally:
-        cmd = 'python pip install {extra} --upgrade {0}'.format(
-            package, extra=self.pip_extra)
-      else:
-        python = os.path.join(self.virtualenv_dir, 'bin/python')
-        cmd = ('"{python}" "{self.virtualenv_dir}/bin/pip" --log="{logv}"'
-               ' install {self.pip_extra} {0}'.format(package,
-                                                      python=python,
-                                                      self=self,
-                                                      logv=logfilename_verbose))
-      self.call_installer(package_short, cmd, logfilename)
+    self.call_installers([self.pip_install_package(package, pip_command)
+                          for package in pip_requirements], env=env)
+    self.step_prefix = ''
+    uv = self.find_uv(globally)
+    if uv:
+      # uv resolves, downloads and installs in parallel, much faster than pip
+      python = os.path.join(self.virtualenv_dir, 'bin/python')
+      self.step_prefix = 'Installing pip packages from '
+      self.call_installer('requirements.txt',
+                          [uv, 'pip', 'install', '--python', python] +
+                          self.uv_args + ['-r', requirements_path],
+                          os.path.join(self.virtualenv_dir,
+                                       'requirements.txt.out'))
+      self.step_prefix = ''
+      return
+    if not self.pip_per_package:
+      # A single pip run resolves everything at once and loads pip only once
+      self.step_prefix = 'Installing pip packages from '
+      self.call_installer(*self.pip_install_command(
+          'requirements.txt', ['-r', requirements_path], pip_command), env=env)
+      self.step_prefix = ''
+      return
+
+    # One pip run (and log) per package, a few at a time
+    self.step_prefix = 'Installing pip package '
+    self.call_installers([self.pip_install_package(package, pip_command)
+                          for package in self.requirements
+                          if package not in pip_requirements],
+                         jobs=self.pip_jobs, env=env)
     self.step_prefix = ''
 
+  def find_uv(self, globally=False):
+    """
+    Path to uv if it should replace pip for this install, otherwise None
+    """
+    if not self.use_uv or globally or self.pip_per_package:
+      return None
+    uv = find_executable('uv')
+    if uv is None:
+      return None
+    # uv only supports python 3.8+ venvs, ask the venv's own interpreter
+    python = os.path.join(self.virtualenv_dir, 'bin/python')
+    try:
+      if subprocess.call([python, '-c',
+                          'import sys; sys.exit(sys.version_info < (3, 8))']):
+        return None
+    except OSError:
+      return None
+    return uv
+
+  def pip_command(self, globally=False):
+    """
+    argv for `pip install`, without the packages to install
+    """
+    if globally:
+      return (['python', 'pip', 'install'] + self.pip_extra_args +
+              ['--upgrade'])
+    return ([os.path.join(self.virtualenv_dir, 'bin/python'),
+             os.path.join(self.virtualenv_dir, 'bin/pip'), 'install'] +
+            self.pip_extra_args)
+
+  def pip_install_package(self, package, pip_command):
+    """
+    (name, argv, logfilename) installing a single package, for
+    call_installers()
+    """
+    match = PACKAGE_URL_NAME_RE.match(package)
+    if match is None:
+      match = PACKAGE_TAIL_NAME_RE.search(package)
+    package_short = match.group(1) if match else package
+    return self.pip_install_command(package_short, [package], pip_command)
+
+  def pip_install_command(self, name, args, pip_command):
+    """
+    (name, argv, logfilename) running pip_command with the given list of
+    args, logging to {venv_dir}/{name}.out
+    """
+    logfilename = os.path.join(self.virtualenv_dir, name + '.out')
+    logfilename_verbose = os.path.join(self.virtualenv_dir, name + '.log')
+    return (name, pip_command + ['--log=' + logfilename_verbose] + args,
+            logfilename)
+
+  def pip_env(self):
+    """
+    Environment for pip, sharing downloads and built wheels between builds
+    """
+    env = os.environ.copy()
+    env.setdefault('PIP_CACHE_DIR', self.pip_cache_dir)
+    env.setdefault('PIP_DOWNLOAD_CACHE', self.pip_cache_dir)  # pip < 6
+    return env
+
   def pip_install_packages_globally(self):
     assert getpass.getuser() == 'root'
-    self.total_steps = len(self.requirements)
+    self.total_steps = self.pip_install_steps()
     self.virtualenv_dir = tempfile.mkdtemp('logs')
     self.pip_install_packages(globally=True)
     shutil.rmtree(self.virtualenv_dir)
@@ -334,51 +640,227 @@ class Autodeps(object):
   def info(self, msg):
     sys.stderr.write('[autodeps] {0}\n'.format(msg))
 
-  def call_installer(self, name, cmd, logfilename=None):
+  def begin_step(self, name):
     """
-    Run a given install command and print progress to stderr
+    Print the progress header for the next step, returns a handle for
+    end_step().  Parallel steps print their whole line at the end instead.
     """
     self.current_step += 1
-    sys.stderr.write(
-        '[{self.current_step:>2}/{self.total_steps:>2}] {self.step_prefix}{0}..'
-        .format(name, self=self))
-    if logfilename:
-      logfile = open(logfilename, 'w')
-    else:
-      logfile = sys.stderr
-    process = subprocess.Popen(cmd, shell=True, stdout=logfile, stderr=logfile)
+    header = '[{0:>2}/{1:>2}] {2}{3}..'.format(
+        self.current_step, self.total_steps, self.step_prefix, name)
+    if not self.parallel_steps:
+      sys.stderr.write(header)
+    return header, time.time()
+
+  def step_progress(self):
+    if not self.parallel_steps:
+      sys.stderr.write('.')
+
+  def end_step(self, step, result=None):
+    header, start = step
+    if result is None:
+      result = 'OK ({0:.2f} sec)'.format(time.time() - start)
+    if self.parallel_steps:
+      sys.stderr.write(header)
+    sys.stderr.write(' {0}\n'.format(result))
+
+  def call_installer(self, name, cmd, logfilename=None, env=None, cwd=None):
+    """
+    Run a given install command (an argv list) and print progress to stderr
+    """
+    self.call_installers([(name, cmd, logfilename)], env=env, cwd=cwd)
+
+  def call_installers(self, commands, jobs=1, env=None, cwd=None):
+    """
+    Run a list of (name, argv, logfilename) install commands, up to `jobs` at
+    a time, all driven from a single select() loop.  After a failure no more
+    commands are started; raise once the running ones are done.
+    """
+    jobs = max(1, jobs)
+    pending = list(reversed(commands))
+    running = dict()  # stdout pipe fd -> Installer
+    failed = []
+    self.parallel_steps = min(jobs, len(commands)) > 1
+    try:
+      while running or (pending and not failed):
+        while pending and not failed and len(running) < jobs:
+          installer = self.start_installer(*pending.pop(), env=env, cwd=cwd)
+          if installer.process:
+            running[installer.pipe] = installer
+          else:
+            failed.append(installer)
+        if not running:
+          continue
+        # Copy output to the logs as it arrives, printing a dot for each chunk
+        readable, _, _ = select.select(list(running), [], [], 1.0)
+        finished = []
+        for pipe in readable:
+          data = os.read(pipe, 65536)
+          if data:
+            os.write(running[pipe].logfile.fileno(), data)
+            self.step_progress()
+          else:
+            finished.append(pipe)
+        if not readable:
+          # exited, but a grandchild may be holding the pipe open
+          finished = [pipe for pipe, installer in running.items()
+                      if installer.process.poll() is not None]
+        for pipe in finished:
+          installer = running.pop(pipe)
+          if not self.finish_installer(installer):
+            failed.append(installer)
+    finally:
+      self.parallel_steps = False
+    if failed:
+      raise Exception('Failed to update dependencies (see {0})\n'.format(
+          failed[0].logfilename))
+
+  def start_installer(self, name, cmd, logfilename, env=None, cwd=None):
+    step = self.begin_step(name)
+    installer = Installer(step, logfilename)
+    try:
+      installer.process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT,
+                                           bufsize=0, env=env, cwd=cwd)
+    except OSError as error:  # e.g. command not found
+      os.write(installer.logfile.fileno(), to_bytes('{0}\n'.format(error)))
+      installer.close()
+      self.end_step(step, 'ERROR (see {0})'.format(logfilename))
+      return installer
+    installer.pipe = installer.process.stdout.fileno()
+    return installer
+
+  def finish_installer(self, installer):
+    """
+    Reap a command from call_installers() and print its result, returns
+    true if it succeeded
+    """
+    installer.process.stdout.close()
+    installer.process.wait()
+    installer.close()
+    if installer.process.returncode == 0:
+      self.end_step(installer.step)
+      return True
+    self.end_step(installer.step,
+                  'ERROR (see {0})'.format(installer.logfilename))
+    return False
+
+
+class Installer(object):
+  """
+  State of one command being run by Autodeps.call_installers()
+  """
+
+  def __init__(self, step, logfilename=None):
+    self.step = step
+    self.logfilename = logfilename
     if logfilename:
-      old_size = os.path.getsize(logfilename)
-    else:
-      old_size = 0
-    n_iterations = 0
-    start = time.time()
-    while process.returncode is None:
-      n_iterations += 1
-      time.sleep(0.05)
-      if logfilename:
-        size = os.path.getsize(logfilename)
-      else:
-        size = 0
-      if size != old_size:
-        old_size = size
-        sys.stderr.write('.')
-      if (n_iterations % 100) == 0:
-        sys.stderr.write(' ')
-      process.poll()
-    if process.returncode == 0:
-      sys.stderr.write(' OK ({0:.2f} sec)\n'.format(time.time() - start))
+      self.logfile = open(logfilename, 'wb')
     else:
-      sys.stderr.write(' ERROR (see {0})\n'.format(logfilename))
-      raise Exception('Failed to update dependencies (see {0})\n'.format(
-          logfilename))
+      self.logfile = sys.stderr
+    self.process = None
+    self.pipe = None
+
+  def close(self):
+    if self.logfilename:
+      self.logfile.close()
 
 
-def freespace_gb(path):
-  while not os.path.exists(path) and path:
-    path = os.path.dirname(path)
+def freespace_gb(path, cache=None):
+  """
+  Free space on the filesystem path is (or would be) created on.  `cache`
+  maps st_dev to earlier results, skipping statvfs for filesystems seen before
+  """
+  while True:
+    try:
+      device = os.stat(path).st_dev
+      break
+    except OSError:
+      parent = os.path.dirname(path)
+      if parent == path:
+        raise
+      path = parent
+  if cache is not None and device in cache:
+    return cache[device]
   s = os.statvfs(path)
-  return s.f_bsize * s.f_bavail / 1024.0 ** 3
+  result = s.f_bsize * s.f_bavail / 1024.0 ** 3
+  if cache is not None:
+    cache[device] = result
+  return result
+
+
+def load_json(path):
+  with open(path, 'rb') as fd:
+    return json.loads(fd.read())
+
+
+def makedirs(path):
+  """
+  Same as os.makedirs(path, exist_ok=True), which python 2 lacks
+  """
+  try:
+    os.makedirs(path)
+  except OSError as error:
+    if error.errno != errno.EEXIST or not os.path.isdir(path):
+      raise
+
+
+def check_tar_member(member, dest):
+  """
+  Raise if extracting tar member into dest could write outside of dest
+  """
+  dest = os.path.realpath(dest)
+
+  def check(condition, reason):
+    if not condition:
+      raise Exception('Refusing to extract {0}: {1}'.format(member.name,
+                                                            reason))
+
+  def inside_dest(path):
+    path = os.path.realpath(path)
+    return path == dest or path.startswith(dest + os.sep)
+
+  check(not os.path.isabs(member.name), 'absolute path')
+  check('..' not in member.name.split('/'), "member name contains '..'")
+  # realpath() also catches writing through symlinks extracted earlier
+  check(inside_dest(os.path.join(dest, member.name)), 'outside destination')
+  if member.issym():
+    check(inside_dest(os.path.join(dest, os.path.dirname(member.name),
+                                   member.linkname)),
+          'symlink points outside destination')
+  elif member.islnk():
+    check(inside_dest(os.path.join(dest, member.linkname)),
+          'hard link points outside destination')
+
+
+def is_url(path):
+  return path.startswith(('http://', 'https://'))
+
+
+def rmtrees(paths):
+  for path in paths:
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def same_filesystem(path1, path2):
+  return os.stat(path1).st_dev == os.stat(path2).st_dev
+
+
+def to_bytes(text):
+  if isinstance(text, bytes):
+    return text
+  return text.encode('utf-8')
+
+
+def find_executable(name):
+  """
+  Return the full path of `name` on $PATH, or None
+  """
+  for directory in os.environ.get('PATH', '').split(os.pathsep):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+  return None
 
 
 def main():